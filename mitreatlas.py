@@ -14,12 +14,16 @@ Use at your own risk!
 # Imports
 import argparse
 import logging
+import os
+import shutil
 import sys
 from pathlib import Path
-import json
+import numpy as np
+import orjson
+import hashlib
 import pyfiglet
 from collections import defaultdict
-from tqdm import tqdm
+from operator import itemgetter
 from colorama import Fore, Style
 
 # Example list of input usecases
@@ -34,7 +38,7 @@ usecases = [
     }
 ]
 
-formatted_json = json.dumps(usecases, indent=2)
+formatted_json = orjson.dumps(usecases, option=orjson.OPT_INDENT_2).decode("utf-8")
 
 # Logger, we are mostly using info
 def setup_logger(verbose: bool = False):
@@ -45,15 +49,16 @@ def setup_logger(verbose: bool = False):
     logging.basicConfig(format="[%(levelname)s] %(message)s", level=level)
     return 0
 
-# To print out the coverage results
+# Static progress bar for a percentage, 50 characters wide
+def bar(percent):
+    n = int(percent / 2)
+    return "█" * n + "─" * (50 - n)
+
+# To print out the coverage results, one line per tactic
 def pretty_print(coverage_data):
     for tactic, stats in coverage_data.items():
         percent = stats["coverage_percent"]
-        bar = tqdm(total=100, bar_format='{l_bar}{bar}| {n_fmt}%')
-        bar.set_description(f"{Fore.YELLOW}{tactic:20s}{Style.RESET_ALL}")
-        bar.update(percent)
-        bar.close()
-        print(f"{Fore.BLUE}Matched {stats['matched']}/{stats['total']} sub-techniques ({percent:.2f}%)\n{Style.RESET_ALL}")
+        print(f"{Fore.YELLOW}{tactic:20s}{Style.RESET_ALL} |{bar(percent)}| {Fore.BLUE}{percent:.2f}% ({stats['matched']}/{stats['total']}){Style.RESET_ALL}")
 
 # Download from github for the latest enterprise-attack json file
 def download_file():
@@ -63,10 +68,13 @@ def download_file():
     output_file = "enterprise-attack.json"
     
     logging.info(f"Downloading file from {url}")
-    response = requests.get(url)
-    
-    with open(output_file, 'wb') as f:
-        f.write(response.content)
+    # Stream straight to disk in 64 KiB chunks instead of buffering the whole file in memory
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        # requests asks for gzip by default, make the raw stream decode it while copying
+        response.raw.decode_content = True
+        with open(output_file, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, length=65536)
     logging.info(f"Downloaded file saved to {output_file}")
 
 # Checks if mitre file provided is valid
@@ -94,169 +102,326 @@ def check_output_file_exists(output_file: str):
 def check_input_file(input_file: str):
     logging.info(f"Checking if {input_file} is valid...")
     try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        raw = Path(input_file).read_bytes()
 
-        if not isinstance(data, list):
+        # The root has to be a list, so skip parsing entirely when it does not start with '['
+        if raw.lstrip()[:1] != b"[":
+            logging.error(f"Please ensure that input json is in the format of: \n{formatted_json}")
+            return False
+
+        data = orjson.loads(raw)
+
+        # Stops at the first item that is not a dict with a name and a description
+        if any(not (isinstance(item, dict) and 'name' in item and 'description' in item) for item in data):
             logging.error(f"Please ensure that input json is in the format of: \n{formatted_json}")
             return False
 
-        for item in data:
-            if not isinstance(item, dict):
-                logging.error(f"Please ensure that input json is in the format of: \n{formatted_json}")
-                return False
-                
-            if 'name' not in item or 'description' not in item:
-                logging.error(f"Please ensure that input json is in the format of: \n{formatted_json}")
-                return False
-            
         logging.info(f"{input_file} is valid!")    
         return True
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Invalid JSON: {e}")
         return False
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         return False
 
-def get_total_sub_techniques(mitrejson: json):
-    
-    objects = mitrejson['objects']
-    # map tactic shortname to tactic name for reference
-    tactics = {obj['x_mitre_shortname']: obj['name'] 
-            for obj in objects if obj.get('type') == 'x-mitre-tactic'}
-
-    # dictionary to count subtechniques per tactic
-    subtechniques_count = defaultdict(int)
-
-    # filter sub-techniques
-    subtechniques = [obj for obj in objects if obj.get('type') == 'attack-pattern' and obj.get('x_mitre_is_subtechnique')]
-
-    for subtech in subtechniques:
-        kill_chain_phases = subtech.get('kill_chain_phases', [])
-        for phase in kill_chain_phases:
-            tactic_shortname = phase.get('phase_name')
-            if tactic_shortname in tactics:
-                subtechniques_count[tactic_shortname] += 1
+# Parses the mitre json with orjson, build_mitre_indices then walks the objects once
+def load_mitre_json(mitre_file: str):
+    with open(mitre_file, "rb") as f:
+        return orjson.loads(f.read())
+
+# Attack patterns share a fixed STIX schema, so their fields are pulled out in one itemgetter call
+# Objects missing one of the fields (e.g. no "revoked" key) fall back to per-field defaults
+ATTACK_PATTERN_FIELDS = ("revoked", "x_mitre_is_subtechnique", "external_references", "kill_chain_phases", "name", "description")
+ATTACK_PATTERN_DEFAULTS = (False, False, [], [], "", "")
+extract_attack_pattern = itemgetter(*ATTACK_PATTERN_FIELDS)
+
+# Single walk over the mitre objects, building everything the tool needs at once:
+# - techniques: non-revoked attack patterns with id, name, description and phases
+# - tactics: tactic shortname to tactic name
+# - tactic_to_subs: tactic shortname to a bitmask of non-revoked sub-techniques, bit i is sub-technique id2idx[id] == i
+# - subcounts: number of sub-techniques per known tactic
+# - id2idx: sub-technique id to its bit index
+def build_mitre_indices(mitre_data):
+    techniques = []
+    tactics = {}
+    tactic_to_subs = defaultdict(int)
+    id2idx = {}
+    phase_counts = defaultdict(int)
 
-    # Log the results for each sub-technique
-    for tactic_shortname, count in subtechniques_count.items():
-        logging.info(f"{tactics[tactic_shortname]} ({tactic_shortname}): {count} sub-techniques found!")
+    techniques_append = techniques.append
+    for obj in mitre_data.get("objects", []):
+        obj_type = obj.get("type")
+
+        if obj_type == "x-mitre-tactic":
+            tactics[obj["x_mitre_shortname"]] = obj["name"]
+            continue
+        if obj_type != "attack-pattern":
+            continue
+
+        try:
+            revoked, is_subtechnique, external_refs, phases, name, description = extract_attack_pattern(obj)
+        except KeyError:
+            revoked, is_subtechnique, external_refs, phases, name, description = (
+                obj.get(field, default) for field, default in zip(ATTACK_PATTERN_FIELDS, ATTACK_PATTERN_DEFAULTS))
+
+        if is_subtechnique:
+            for phase in phases:
+                phase_counts[phase.get("phase_name")] += 1
+
+        if revoked:
+            continue
+
+        # Malformed objects without an external id are rare, so try/except is cheaper than defensive .get chains
+        try:
+            external_id = external_refs[0]["external_id"]
+        except (KeyError, IndexError):
+            continue
+
+        phase_names = [phase.get("phase_name", "") for phase in phases]
+        techniques_append({
+            "id": external_id,
+            "name": name,
+            "description": description,
+            "phases": phase_names
+        })
 
-def load_subtechniques_by_tactic(mitre_data):
-    tactic_to_subtechniques = defaultdict(set)
+        if is_subtechnique:
+            bit = 1 << id2idx.setdefault(external_id, len(id2idx))
+            for phase_name in phase_names:
+                if phase_name:
+                    tactic_to_subs[phase_name] |= bit
 
-    for obj in mitre_data.get("objects", []):
-        if obj.get("type") == "attack-pattern" and not obj.get("revoked", False):
-            if obj.get("x_mitre_is_subtechnique", False):
-                external_refs = obj.get("external_references", [])
-                if external_refs and isinstance(external_refs, list):
-                    external_id = external_refs[0].get("external_id")
-                    phases = [p["phase_name"] for p in obj.get("kill_chain_phases", []) if "phase_name" in p]
-                    for phase in phases:
-                        tactic_to_subtechniques[phase].add(external_id)
-    return tactic_to_subtechniques
+    # Tactics can appear after the techniques in the file, so only filter the counts at the end
+    subcounts = {tactic: count for tactic, count in phase_counts.items() if tactic in tactics}
+    return techniques, tactics, tactic_to_subs, subcounts, id2idx
 
 # To extract the subtechnique after generating the results in a dictionary format for each tid
-def extract_matched_subtechniques_by_tactic(results_json):
-    matched = defaultdict(set)
+# Matched sub-techniques are returned as a bitmask per tactic, using the bit indices from build_mitre_indices
+def extract_matched_subtechniques_by_tactic(results_json, id2idx: dict):
+    matched = defaultdict(int)
     for entry in results_json:
         for match in entry["matches"]:
             tid = match["id"]
-            if "." in tid: 
-                for phase in match.get("phases", []):
-                    matched[phase].add(tid)
+            if "." not in tid:
+                continue
+            try:
+                phases = match["phases"]
+                bit = 1 << id2idx[tid]
+            except KeyError:
+                continue
+            for phase in phases:
+                matched[phase] |= bit
     return matched
 
 
-def calculate_coverage_per_tactic(mitre_json_file, results_json_file):
-    logging.info(f"Calculating score for each technique...")
+# Turns a list of integer bitmasks into a (len(masks), n_bits) uint8 array of 0/1
+def unpack_masks(masks: list, n_bits: int):
+    n_bytes = max((n_bits + 7) // 8, 1)
+    packed = np.frombuffer(b"".join(mask.to_bytes(n_bytes, "little") for mask in masks), dtype=np.uint8)
+    return np.unpackbits(packed.reshape(len(masks), n_bytes), axis=1, count=n_bits, bitorder="little")
 
-    with open(mitre_json_file, "r", encoding="utf-8") as f:
-        mitre_data = json.load(f)
+# mitre_indices is the output of build_mitre_indices, already built by load_mitre_techniques
+# results_data is the list of results returned by mitre_semantic
+def calculate_coverage_per_tactic(mitre_indices, results_data: list):
+    logging.info(f"Calculating score for each technique...")
 
-    with open(results_json_file, "r", encoding="utf-8") as f:
-        results_data = json.load(f)
+    _, _, total_subs, _, id2idx = mitre_indices
+    matched_subs = extract_matched_subtechniques_by_tactic(results_data, id2idx)
 
-    total_subs = load_subtechniques_by_tactic(mitre_data)
-    matched_subs = extract_matched_subtechniques_by_tactic(results_data)
+    # Unpack the bitmasks into (n_tactics, n_subs) arrays and score every tactic in one go
+    tactic_names = list(total_subs)
+    total = unpack_masks([total_subs[tactic] for tactic in tactic_names], len(id2idx))
+    matched = unpack_masks([matched_subs.get(tactic, 0) for tactic in tactic_names], len(id2idx))
+    matched_counts = (matched & total).sum(axis=1)
+    total_counts = total.sum(axis=1)
+    scores = matched_counts / np.maximum(total_counts, 1) * 100
 
     coverage = {}
-    for tactic, total_ids in total_subs.items():
-        matched_ids = matched_subs.get(tactic, set())
-        score = (len(matched_ids) / len(total_ids)) * 100 if total_ids else 0
+    for tactic, matched_count, total_count, score in zip(tactic_names, matched_counts.tolist(), total_counts.tolist(), scores.tolist()):
         coverage[tactic] = {
-            "matched": len(matched_ids),
-            "total": len(total_ids),
+            "matched": matched_count,
+            "total": total_count,
             "coverage_percent": round(score, 2)
         }
 
     return coverage
 
-def extract_techniques(data):
-    techniques = []
-    for obj in data.get("objects", []):
-        if obj.get("type") == "attack-pattern" and not obj.get("revoked", False):
-            external_id = obj.get("external_references", [{}])[0].get("external_id", "null")
-
-            techniques.append({
-                "id": external_id,
-                "name": obj.get("name", ""),
-                "description": obj.get("description", ""),
-                "phases": [phase.get("phase_name", "") for phase in obj.get("kill_chain_phases", [])]
-            })
-    return techniques
-
 def load_mitre_techniques(mitre_file: str):
     logging.info(f"Loading {mitre_file}...")
     
     try:
-        with open(mitre_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        techniques = extract_techniques(data)
-        get_total_sub_techniques(data)
-        
-                
+        mitre_indices = build_mitre_indices(load_mitre_json(mitre_file))
+        techniques, tactics, _, subcounts, _ = mitre_indices
+
+        # Log the results for each sub-technique
+        for tactic_shortname, count in subcounts.items():
+            logging.info(f"{tactics[tactic_shortname]} ({tactic_shortname}): {count} sub-techniques found!")
+
     except Exception as e:
         logging.error(f"Error while loading Mitre Att&ck json file: {e}")
         sys.exit(1)
 
     logging.info(f"Loading complete!")
-    return techniques
+    return techniques, mitre_indices
 
+# Encodes texts into normalized float32 embeddings, on whichever device the model lives on
+# On CPU the encoder parallelizes through torch intra-op threads, see usable_cpu_count
+def encode_texts(model, texts: list, batch_size: int = 32):
+    import torch
 
+    with torch.inference_mode():
+        embeddings = model.encode(texts, batch_size=batch_size, normalize_embeddings=True, show_progress_bar=True)
+
+    # The model may run in half precision, scoring expects float32
+    return np.asarray(embeddings, dtype=np.float32)
+
+# Cores this process may actually run on, respecting affinity and cgroup cpusets where the OS exposes them
+def usable_cpu_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# bf16 on CPU is only faster with AMX, which linux reports in the cpu flags
+def cpu_supports_amx():
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            return "amx_bf16" in f.read()
+    except OSError:
+        return False
+
+# Loads the model from the local huggingface cache, only going to the network on the first run
+def load_sentence_transformer(semantic_model: str, device: str):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    try:
+        model = SentenceTransformer(semantic_model, device=device, local_files_only=True)
+    except OSError:
+        logging.info(f"{semantic_model} is not cached locally, downloading it...")
+        model = SentenceTransformer(semantic_model, device=device)
+
+    # Half precision halves the memory traffic of the encoder, fp16 on GPU and bf16 on CPUs with AMX
+    if device == "cuda":
+        model.half()
+    elif cpu_supports_amx():
+        model.to(dtype=torch.bfloat16)
+    return model
+
+# Encoding the whole mitre corpus is the slowest step, so the embeddings are cached on disk
+# keyed by the model name, its dtype and the technique texts. A new model or mitre file gives a new key.
+def get_or_build_embeddings(model, texts: list, key: str):
+    import torch
+
+    cache_file = Path(f".cache/{key}.pt")
+    if cache_file.is_file():
+        logging.info(f"Loading cached technique embeddings from {cache_file}")
+        return torch.load(cache_file)
+
+    logging.info(f"No cached embeddings found, encoding {len(texts)} techniques...")
+    embeddings = torch.from_numpy(encode_texts(model, texts))
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(embeddings, cache_file)
+    logging.info(f"Technique embeddings cached to {cache_file}")
+    return embeddings
+
+# Ranks techniques for each usecase with the sentence_transformers model, returns top scores and indices
+def semantic_top_matches(semantic_model: str, technique_texts: list, detection_texts: list, top_k: int):
+    # Nothing to encode, batched encode would return a 1-D empty result
+    if not detection_texts:
+        return [], []
 
-def mitre_semantic(input_file: str, output_file: str, semantic_model:str, remove_score: bool, techniques: list ):
-    
     logging.info(f"Initializing sentence_transformers. Please be patient...")
-    from sentence_transformers import SentenceTransformer, util
+    import torch
+    from sentence_transformers import util
     logging.info(f"sentence_transformers loaded!")
     logging.info(f"Semantic model used: {semantic_model}")
-    logging.info(f"Input JSON file: {input_file}")
+
+    # Use the GPU when there is one, otherwise let torch use every CPU core
+    if torch.cuda.is_available():
+        device = "cuda"
+    else:
+        device = "cpu"
+        torch.set_num_threads(usable_cpu_count())
 
     # The model that i've tested is mostly on all-MiniLM-L6-v2, which was giving me fairly decent results
-    model = SentenceTransformer(f"{semantic_model}")
+    model = load_sentence_transformer(semantic_model, device)
+
+    # Encode mitre descriptions, which converts it into a vector to capture semantic meaning
+    # The model dtype is part of the key, fp16/bf16 and fp32 runs give slightly different embeddings
+    model_dtype = str(next(model.parameters()).dtype)
+    cache_key = hashlib.sha1("\n".join([semantic_model, model_dtype, *technique_texts]).encode("utf-8")).hexdigest()
+    technique_embeddings = get_or_build_embeddings(model, technique_texts, cache_key)
+
+    # Both sides come out of encode_texts already unit length, so a plain dot product is the cosine
+    # and no norms are recomputed per query
+    detection_embeddings = torch.from_numpy(encode_texts(model, detection_texts, batch_size=64))
+
+    # semantic_search works through the corpus in chunks so the full score matrix is never built
+    hits = util.semantic_search(detection_embeddings,
+                                technique_embeddings,
+                                top_k=top_k,
+                                corpus_chunk_size=500,
+                                query_chunk_size=100,
+                                score_function=util.dot_score)
+    top_vals = [[hit["score"] for hit in query_hits] for query_hits in hits]
+    top_idx = [[hit["corpus_id"] for hit in query_hits] for query_hits in hits]
+    return top_vals, top_idx
+
+# Fast path without torch, char n-gram TF-IDF with a cosine nearest neighbours index
+# The fitted vectorizer and index are cached with joblib, keyed by the technique texts
+def tfidf_top_matches(technique_texts: list, detection_texts: list, top_k: int):
+    import joblib
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.neighbors import NearestNeighbors
+    logging.info(f"Using TF-IDF fast path")
+
+    cache_key = hashlib.sha1("\n".join(["tfidf", str(top_k), *technique_texts]).encode("utf-8")).hexdigest()
+    cache_file = Path(f".cache/{cache_key}.joblib")
+    if cache_file.is_file():
+        logging.info(f"Loading cached TF-IDF index from {cache_file}")
+        vectorizer, index = joblib.load(cache_file)
+    else:
+        logging.info(f"No cached TF-IDF index found, fitting on {len(technique_texts)} techniques...")
+        vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4))
+        technique_matrix = vectorizer.fit_transform(technique_texts)
+        index = NearestNeighbors(n_neighbors=top_k, metric="cosine").fit(technique_matrix)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        joblib.dump((vectorizer, index), cache_file)
+        logging.info(f"TF-IDF index cached to {cache_file}")
+
+    # kneighbors rejects an empty query matrix
+    if not detection_texts:
+        return [], []
+
+    distances, indices = index.kneighbors(vectorizer.transform(detection_texts))
+    return (1 - distances).tolist(), indices.tolist()
+
+def mitre_semantic(input_file: str, output_file: str, semantic_model:str, remove_score: bool, techniques: list, fast: bool = False):
+    
+    logging.info(f"Input JSON file: {input_file}")
 
     # Loading of use case in JSON
-    with open(input_file, "r", encoding="utf-8") as f:
-        usecases = json.load(f)
+    with open(input_file, "rb") as f:
+        usecases = orjson.loads(f.read())
 
-    # Encode mitre descriptions, which converts it into a vector to capture semantic meaning
     technique_texts = [i["description"] for i in techniques]
-    technique_embeddings = model.encode(technique_texts, convert_to_tensor=True)
+    detection_texts = [uc["description"] for uc in usecases]
+    top_k = min(5, len(techniques))
+
+    if fast:
+        top_vals, top_idx = tfidf_top_matches(technique_texts, detection_texts, top_k)
+    else:
+        top_vals, top_idx = semantic_top_matches(semantic_model, technique_texts, detection_texts, top_k)
 
     results = []
 
-    for uc in usecases:
+    for i, uc in enumerate(usecases):
         logging.info(f'Parsing usecase: {uc["name"]}')
         detection_desc = uc["description"]
-        detection_embedding = model.encode(detection_desc, convert_to_tensor=True)
-        cos_scores = util.cos_sim(detection_embedding, technique_embeddings)[0]
-        top_results = cos_scores.topk(5)
 
         matches = []
-        for score, idx in zip(top_results.values, top_results.indices):
+        for score, idx in zip(top_vals[i], top_idx[i]):
             tech = techniques[idx]
             if remove_score:
                 matches.append({
@@ -269,7 +434,7 @@ def mitre_semantic(input_file: str, output_file: str, semantic_model:str, remove
                     "id": tech["id"],
                     "name": tech["name"],
                     "phases": tech.get("phases", []),
-                    "score": round(score.item(), 3)
+                    "score": round(score, 3)
                 })
 
         results.append({
@@ -280,10 +445,10 @@ def mitre_semantic(input_file: str, output_file: str, semantic_model:str, remove
 
 
     # Save results to JSON
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=2)
+    with open(output_file, "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
 
-    return 0
+    return results
 
 def main():
     parser = argparse.ArgumentParser(
@@ -315,6 +480,11 @@ def main():
         help="Removes the score in the output file",
         action="store_true"
     )
+    parser.add_argument(
+        "-f", "--fast",
+        help="Use a lightweight TF-IDF similarity instead of the semantic model, skips loading torch",
+        action="store_true"
+    )
     parser.add_argument(
         "-d", "--download",
         help="Download Mitre Att&ck enterprise json file from github",
@@ -345,14 +515,15 @@ Use at your own risk!
             if args.download:
                 download_file()
             check_mitre_json(mitre_file = args.mitrejson)
-            techniques = load_mitre_techniques(mitre_file = args.mitrejson)
-            mitre_semantic(input_file = args.input,  
+            techniques, mitre_indices = load_mitre_techniques(mitre_file = args.mitrejson)
+            semantic_results = mitre_semantic(input_file = args.input,  
                         output_file =  args.output,
                         semantic_model =args.semantic_model,
                         remove_score = args.removescore,
-                        techniques=techniques)
+                        techniques=techniques,
+                        fast = args.fast)
             
-            results = (calculate_coverage_per_tactic(args.mitrejson, args.output))
+            results = (calculate_coverage_per_tactic(mitre_indices, semantic_results))
             pretty_print(results)
             logging.info(f"Mitre Atlas has completed its job.\n You may check for the generated results here: {args.output}.\n\n Exiting silently now...")
             sys.exit(0)